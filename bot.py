@@ -1,22 +1,27 @@
 import os
 import logging
-import json
+import orjson
+import re
+import html
 import time
 import random
+import itertools
 import asyncio
 import sys
-import tempfile
+import sqlite3
+import signal
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, ChatJoinRequestHandler, ContextTypes
+from telegram.ext import AIORateLimiter, Application, CommandHandler, CallbackQueryHandler, MessageHandler, ChatJoinRequestHandler, ContextTypes
 from telegram.ext import filters
-from telegram.error import RetryAfter
+from telegram.error import BadRequest, NetworkError, TimedOut
+from telegram.request import HTTPXRequest
 from google.oauth2.service_account import Credentials
 from gspread_asyncio import AsyncioGspreadClientManager
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple
 import telegram
 from tenacity import retry, stop_after_attempt, wait_fixed
-from cachetools import LRUCache
+from cachetools import LRUCache, TTLCache
 from aiohttp import web
 
 # Configure logging
@@ -25,18 +30,23 @@ logging.basicConfig(
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+# httpx пишет INFO-строку на каждый запрос к Bot API
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
-logger.info(f"python-telegram-bot version: {telegram.__version__}")
+logger.info("python-telegram-bot version: %s", telegram.__version__)
 
 # Configuration from environment variables
 TOKEN = os.environ.get("BOT_TOKEN")
 GOOGLE_CREDENTIALS_JSON = os.environ.get("GOOGLE_CREDENTIALS_JSON")
 GOOGLE_CREDENTIALS_PATH = "google-credentials.json"
 BOT_USERNAME = os.environ.get("BOT_USERNAME")
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", 32))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+MAX_WEBHOOK_BODY_SIZE = 1_000_000
 
 if BOT_USERNAME and BOT_USERNAME.startswith("@"):
     BOT_USERNAME = BOT_USERNAME[1:]
-    logger.info(f"Removed '@' from BOT_USERNAME: {BOT_USERNAME}")
+    logger.info("Removed '@' from BOT_USERNAME: %s", BOT_USERNAME)
 
 MOVIE_SHEET_ID = "1hmm-rfUlDcA31QD04XRXIyaa_EpN8ObuHFc8cp7Rwms"
 USER_SHEET_ID = "1XYFfqmC5boLBB8HjjkyKA6AyN3WNCKy6U8LEmN8KvrA"
@@ -44,21 +54,22 @@ JOIN_REQUESTS_SHEET_ID = "1OKteXrJFjKC7B2qbwoVkt-rfbkCGdYt2VjMcZRjtQ84"
 
 
 UNLIMITED_USERS = [6231911786]
+ADMIN_USERS = [6231911786]
 
 try:
-    CHANNELS = json.loads(os.environ.get("CHANNEL_IDS", "[]"))
-    CHANNEL_BUTTONS = json.loads(os.environ.get("CHANNEL_BUTTONS", "[]"))
+    CHANNELS = orjson.loads(os.environ.get("CHANNEL_IDS", "[]"))
+    CHANNEL_BUTTONS = orjson.loads(os.environ.get("CHANNEL_BUTTONS", "[]"))
     if not CHANNELS or not CHANNEL_BUTTONS:
         logger.error("CHANNEL_IDS or CHANNEL_BUTTONS are empty or not set.")
         raise ValueError("CHANNEL_IDS and CHANNEL_BUTTONS must be set.")
     if len(CHANNELS) != len(CHANNEL_BUTTONS):
         logger.error("Number of channels and buttons do not match.")
         raise ValueError("Number of CHANNEL_IDS and CHANNEL_BUTTONS must match.")
-except json.JSONDecodeError as e:
-    logger.error(f"Error parsing JSON in CHANNEL_IDS or CHANNEL_BUTTONS: {e}")
+except orjson.JSONDecodeError as e:
+    logger.error("Error parsing JSON in CHANNEL_IDS or CHANNEL_BUTTONS: %s", e)
     raise
 except ValueError as e:
-    logger.error(f"Configuration error for channels: {e}")
+    logger.error("Configuration error for channels: %s", e)
     raise
 
 if not TOKEN:
@@ -71,47 +82,96 @@ if not BOT_USERNAME:
 movie_sheet = None
 user_sheet = None
 join_requests_sheet = None
-MOVIE_DICT = LRUCache(maxsize=5000)
-USER_DICT = LRUCache(maxsize=5000)
-JOIN_REQUESTS_DICT = {}
-MOVIE_CACHE_REFRESH_INTERVAL = 60
+MOVIE_DICT: Dict[str, str] = {}
+MOVIE_CACHE_LOCK = asyncio.Lock()
+# Лист Users — источник данных о поисках и рефералах: кэш хранит всех пользователей, без вытеснения
+USER_DICT: Dict[str, Dict[str, str]] = {}
+# Номер строки пользователя в листе Users: запись идёт сразу в нужную строку, без чтения всего листа
+USER_ROWS: Dict[str, int] = {}
+USER_SHEET_LOCK = asyncio.Lock()
+# Изменения пользователей и заявки копятся в памяти и раз в несколько секунд уходят в таблицы пакетами
+PENDING_USER_APPENDS: Dict[str, List[str]] = {}
+PENDING_USER_UPDATES: Dict[str, List[str]] = {}
+SHEET_FLUSH_INTERVAL = 3
+# Квота Sheets — 60 запросов на запись в минуту: держимся ниже и ограничиваем размер одного пакета
+SHEET_WRITES_PER_MINUTE = 50
+SHEET_WRITE_BURST = 5
+SHEET_MAX_BATCH_ROWS = 500
+SHEET_WRITE_TOKENS = float(SHEET_WRITE_BURST)
+SHEET_WRITE_CHECKED_AT = 0.0
+# Все заявки на вступление (user_id, channel_id): без ограничения размера, иначе старые заявки «терялись» при проверке подписки
+JOIN_REQUESTS: set = set()
+PENDING_JOIN_REQUESTS: List[List[str]] = []
+JOIN_REQUESTS_LOCK = asyncio.Lock()
+PROCESSED_UPDATE_IDS = LRUCache(maxsize=4096)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_JOIN_REQUEST]
+MEMBER_STATUSES = frozenset({"member", "administrator", "creator"})
+INVITE_PREFIX = "/start invite_"
+# Код фильма — только цифры; fullmatch, в отличие от $, не пропускает завершающий перевод строки
+DIGIT_RE = re.compile(r'\d+')
+# Таблица фильмов меняется редко: фоновое обновление раз в 10 минут, срочное — через /resetcache
+MOVIE_CACHE_REFRESH_INTERVAL = int(os.environ.get("MOVIE_CACHE_REFRESH_INTERVAL", 600))
+# Снимок таблицы фильмов на диске: после рестарта бот сразу отвечает, не дожидаясь загрузки из Sheets
+MOVIE_CACHE_DB_PATH = os.environ.get("MOVIE_CACHE_DB_PATH", "movie_cache.sqlite3")
 OTHER_CACHE_REFRESH_INTERVAL = 300
-
-async def init_google_sheets():
-    global movie_sheet, user_sheet, join_requests_sheet
-    try:
+LOOKUP_STATS_INTERVAL = 30
+NETWORK_RETRY_ATTEMPTS = 3
+NETWORK_RETRY_DELAY = 1
+NETWORK_RETRY_MAX_DELAY = 60
+SUBSCRIPTION_RECHECK_TTL = 300
+# Кэшируем только подтверждённое членство: отказ перепроверяется сразу, иначе кнопка «Я ПОДПИСАЛСЯ» не сработает после подписки
+SUBSCRIPTION_CACHE = TTLCache(maxsize=100000, ttl=SUBSCRIPTION_RECHECK_TTL)
+# Подтверждение подписки хранится в колонке F листа Users и переживает рестарт бота
+SUBSCRIPTION_RESTORE_TTL = 600
+# Личный лимит на текстовые сообщения: 1 в секунду с запасом на 3 подряд, лишние отбрасываются без обработки
+USER_MESSAGE_RATE = 1.0
+USER_MESSAGE_BURST = 3
+MOVIE_LOOKUP_HITS = 0
+MOVIE_LOOKUP_MISSES = 0
+
+GOOGLE_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+google_credentials = None
+
+def get_google_credentials() -> Credentials:
+    # Ключ сервисного аккаунта разбирается один раз; повторная авторизация берёт готовый объект
+    global google_credentials
+    if google_credentials is None:
         if GOOGLE_CREDENTIALS_JSON:
             logger.info("Using Google credentials from GOOGLE_CREDENTIALS_JSON environment variable.")
-            credentials_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
-            with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as temp_file:
-                json.dump(credentials_dict, temp_file)
-                temp_file_path = temp_file.name
+            google_credentials = Credentials.from_service_account_info(orjson.loads(GOOGLE_CREDENTIALS_JSON), scopes=GOOGLE_SCOPES)
         else:
             if not os.path.exists(GOOGLE_CREDENTIALS_PATH):
-                logger.error(f"Credentials file not found at: {GOOGLE_CREDENTIALS_PATH}")
+                logger.error("Credentials file not found at: %s", GOOGLE_CREDENTIALS_PATH)
                 raise FileNotFoundError(f"Credentials file not found at: {GOOGLE_CREDENTIALS_PATH}")
-            temp_file_path = GOOGLE_CREDENTIALS_PATH
-
-        scope = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        creds = Credentials.from_service_account_file(temp_file_path, scopes=scope)
-        client_manager = AsyncioGspreadClientManager(lambda: creds)
+            google_credentials = Credentials.from_service_account_file(GOOGLE_CREDENTIALS_PATH, scopes=GOOGLE_SCOPES)
+    return google_credentials
+
+async def init_google_sheets():
+    global movie_sheet, user_sheet, join_requests_sheet
+    try:
+        await asyncio.to_thread(get_google_credentials)
+        client_manager = AsyncioGspreadClientManager(get_google_credentials)
         client = await client_manager.authorize()
 
         movie_spreadsheet = await client.open_by_key(MOVIE_SHEET_ID)
         movie_sheet = await movie_spreadsheet.get_worksheet(0)
-        logger.info(f"Movie sheet initialized (ID: {MOVIE_SHEET_ID}).")
+        logger.info("Movie sheet initialized (ID: %s).", MOVIE_SHEET_ID)
         
         user_spreadsheet = await client.open_by_key(USER_SHEET_ID)
         try:
             user_sheet = await user_spreadsheet.worksheet("Users")
         except Exception:
-            user_sheet = await user_spreadsheet.add_worksheet(title="Users", rows=1000, cols=5)
-            await user_sheet.append_row(["user_id", "username", "first_name", "search_queries", "invited_users"])
-            logger.info(f"Created new 'Users' worksheet (ID: {USER_SHEET_ID}).")
-        logger.info(f"User sheet initialized (ID: {USER_SHEET_ID}).")
+            user_sheet = await user_spreadsheet.add_worksheet(title="Users", rows=1000, cols=6)
+            await user_sheet.append_row(["user_id", "username", "first_name", "search_queries", "invited_users", "subscribed_at"])
+            logger.info("Created new 'Users' worksheet (ID: %s).", USER_SHEET_ID)
+        if user_sheet.col_count < 6:
+            # Старые листы созданы с пятью колонками — добавляем колонку F для времени подписки
+            await user_sheet.add_cols(6 - user_sheet.col_count)
+            await user_sheet.update("F1", [["subscribed_at"]])
+        logger.info("User sheet initialized (ID: %s).", USER_SHEET_ID)
         
         join_requests_spreadsheet = await client.open_by_key(JOIN_REQUESTS_SHEET_ID)
         try:
@@ -119,109 +179,170 @@ async def init_google_sheets():
         except Exception:
             join_requests_sheet = await join_requests_spreadsheet.add_worksheet(title="JoinRequests", rows=1000, cols=2)
             await join_requests_sheet.append_row(["user_id", "channel_id"])
-            logger.info(f"Created new 'JoinRequests' worksheet (ID: {JOIN_REQUESTS_SHEET_ID}).")
-        logger.info(f"Join Requests sheet initialized (ID: {JOIN_REQUESTS_SHEET_ID}).")
-
-        if GOOGLE_CREDENTIALS_JSON:
-            os.unlink(temp_file_path)
-            logger.info(f"Temporary credentials file deleted: {temp_file_path}")
+            logger.info("Created new 'JoinRequests' worksheet (ID: %s).", JOIN_REQUESTS_SHEET_ID)
+        logger.info("Join Requests sheet initialized (ID: %s).", JOIN_REQUESTS_SHEET_ID)
     except Exception as e:
-        logger.error(f"Error initializing Google Sheets: {e}")
-        if GOOGLE_CREDENTIALS_JSON and 'temp_file_path' in locals():
-            os.unlink(temp_file_path)
-            logger.info(f"Temporary credentials file deleted after error: {temp_file_path}")
+        logger.error("Error initializing Google Sheets: %s", e)
         raise
 
+def build_movie_index(all_values: List[List[str]]) -> Dict[str, str]:
+    movie_index = {}
+    for row in all_values:
+        if len(row) >= 2:
+            code = row[0].strip()
+            if code.lower() in ["code", "код"]:  # Пропустить заголовок
+                continue
+            movie_index[code] = row[1].strip()
+    return movie_index
+
+def read_movie_snapshot() -> Dict[str, str]:
+    if not os.path.exists(MOVIE_CACHE_DB_PATH):
+        return {}
+    conn = sqlite3.connect(MOVIE_CACHE_DB_PATH)
+    try:
+        return dict(conn.execute("SELECT code, title FROM movies"))
+    finally:
+        conn.close()
+
+def write_movie_snapshot(movie_index: Dict[str, str]) -> None:
+    conn = sqlite3.connect(MOVIE_CACHE_DB_PATH, isolation_level=None)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS movies (code TEXT PRIMARY KEY, title TEXT)")
+        conn.execute("BEGIN IMMEDIATE")
+        # Снимок полностью заменяется: удалённые из таблицы коды не должны воскресать после рестарта
+        conn.execute("DELETE FROM movies")
+        conn.executemany("INSERT OR REPLACE INTO movies (code, title) VALUES (?, ?)", movie_index.items())
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+async def load_movie_snapshot() -> bool:
+    global MOVIE_DICT
+    try:
+        snapshot = await asyncio.to_thread(read_movie_snapshot)
+    except sqlite3.Error as e:
+        logger.error("Error reading movie snapshot from %s: %s", MOVIE_CACHE_DB_PATH, e)
+        return False
+    if not snapshot:
+        return False
+    MOVIE_DICT = snapshot
+    logger.info("Loaded %s movies from snapshot %s.", len(MOVIE_DICT), MOVIE_CACHE_DB_PATH)
+    return True
+
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 async def load_movie_cache():
     global MOVIE_DICT
-    try:
-        # Получить все значения из таблицы
-        all_values = await movie_sheet.get_all_values()
-        if not all_values:
-            logger.info("No data in MovieDatabase sheet.")
+    if MOVIE_CACHE_LOCK.locked():
+        # Обновление уже идёт — дождаться его вместо повторного запроса к таблице
+        async with MOVIE_CACHE_LOCK:
             return
+    async with MOVIE_CACHE_LOCK:
+        try:
+            # Код и название лежат в колонках A и B — остальные колонки не качаем
+            all_values = await movie_sheet.get_values("A:B")
+            if not all_values:
+                logger.info("No data in MovieDatabase sheet.")
+                return
 
-        # Определить количество заполненных строк
-        total_rows = len(all_values)
-        last_row = getattr(load_movie_cache, "last_row", 0)
-
-        # Если last_row больше или равно количеству строк, начать с начала
-        if last_row >= total_rows:
-            logger.info(f"No new rows to load. Total rows: {total_rows}, last processed: {last_row}")
-            last_row = 0  # Сбросить last_row для полной перезагрузки
-            load_movie_cache.last_row = 0
-
-        # Загрузить новые строки (начиная с last_row + 1)
-        new_values = all_values[last_row:]  # Берем строки после last_row
-        added_movies = 0
-        for row in new_values:
-            if len(row) >= 2:
-                code = row[0].strip()
-                if last_row == 0 and code.lower() in ["code", "код"]:  # Пропустить заголовок
-                    continue
-                MOVIE_DICT[code] = row[1].strip()
-                added_movies += 1
-        load_movie_cache.last_row = total_rows
-        logger.info(f"Loaded {added_movies} new movies into cache. Total in cache: {len(MOVIE_DICT)}")
-    except Exception as e:
-        logger.error(f"Error loading movie data into cache: {e}")
-
-
+            MOVIE_DICT = await asyncio.to_thread(build_movie_index, all_values)
+            logger.info("Loaded %s movies into cache.", len(MOVIE_DICT))
+        except Exception as e:
+            logger.error("Error loading movie data into cache: %s", e)
+            return
+        try:
+            await asyncio.to_thread(write_movie_snapshot, MOVIE_DICT)
+        except sqlite3.Error as e:
+            logger.error("Error writing movie snapshot to %s: %s", MOVIE_CACHE_DB_PATH, e)
+
+def load_user_rows(all_values: List[List[str]]) -> None:
+    USER_ROWS.clear()
+    USER_ROWS.update((row[0], idx) for idx, row in enumerate(all_values[1:], start=2) if row)
+
+def parse_appended_row(response: dict) -> Optional[int]:
+    # append_rows возвращает диапазон вида "Users!A42:E44" — из него берём номер первой новой строки
+    updated_range = response.get("updates", {}).get("updatedRange", "")
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+def user_record(row: List[str]) -> Dict[str, str]:
+    return {
+        "user_id": row[0],
+        "username": row[1] if len(row) > 1 else "",
+        "first_name": row[2] if len(row) > 2 else "",
+        "search_queries": row[3] if len(row) > 3 else "0",
+        "invited_users": row[4] if len(row) > 4 else "0",
+        "subscribed_at": row[5] if len(row) > 5 else ""
+    }
 
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 async def load_user_cache():
     global USER_DICT
     try:
-        all_values = await user_sheet.get_all_values()
-        new_dict = {
-            row[0]: {
-                "user_id": row[0],
-                "username": row[1] if len(row) > 1 else "",
-                "first_name": row[2] if len(row) > 2 else "",
-                "search_queries": row[3] if len(row) > 3 else "0",
-                "invited_users": row[4] if len(row) > 4 else "0"
-            } for row in all_values[1:] if row and len(row) >= 1
-        }
-        USER_DICT.clear()
-        USER_DICT.update(new_dict)
-        logger.info(f"Loaded {len(USER_DICT)} users into cache.")
+        # Бот использует только колонки A–F листа Users
+        # Под блокировкой записи: кэш и номера строк не перетрут параллельное изменение пользователя
+        async with USER_SHEET_LOCK:
+            all_values = await user_sheet.get_values("A:F")
+            load_user_rows(all_values)
+            # Пользователя нет в таблице (например, строку удалили) — его изменения уходят повторным добавлением
+            for uid in [uid for uid in PENDING_USER_UPDATES if uid not in USER_ROWS]:
+                if uid not in PENDING_USER_APPENDS:
+                    PENDING_USER_APPENDS[uid] = PENDING_USER_UPDATES.pop(uid)
+            new_dict = {row[0]: user_record(row) for row in all_values[1:] if row and len(row) >= 1}
+            # Ещё не записанные в таблицу изменения новее прочитанных строк
+            for pending in (PENDING_USER_APPENDS, PENDING_USER_UPDATES):
+                new_dict.update((uid, user_record(row)) for uid, row in pending.items())
+            USER_DICT.clear()
+            USER_DICT.update(new_dict)
+        logger.info("Loaded %s users into cache.", len(USER_DICT))
     except Exception as e:
-        logger.error(f"Error loading user cache: {e}")
+        logger.error("Error loading user cache: %s", e)
 
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 async def load_join_requests_cache():
-    global JOIN_REQUESTS_DICT
+    global JOIN_REQUESTS
     try:
-        all_values = await join_requests_sheet.get_all_values()
-        new_dict = {(row[0], row[1]): True for row in all_values[1:] if row and len(row) >= 2}
-        if len(new_dict) > 10000:
-            new_dict = dict(list(new_dict.items())[-10000:])
-        JOIN_REQUESTS_DICT.clear()
-        JOIN_REQUESTS_DICT.update(new_dict)
-        logger.info(f"Loaded {len(JOIN_REQUESTS_DICT)} join requests into cache.")
+        # Под блокировкой выгрузки: пачка в процессе записи не пропадёт из кэша
+        async with JOIN_REQUESTS_LOCK:
+            all_values = await join_requests_sheet.get_values("A:B")
+            JOIN_REQUESTS = {(row[0], row[1]) for row in all_values[1:] if row and len(row) >= 2}
+            # Заявки из очереди ещё не попали в таблицу, но уже должны учитываться
+            JOIN_REQUESTS.update(tuple(row) for row in PENDING_JOIN_REQUESTS)
+        logger.info("Loaded %s join requests into cache.", len(JOIN_REQUESTS))
     except Exception as e:
-        logger.error(f"Error loading join requests cache: {e}")
+        logger.error("Error loading join requests cache: %s", e)
 
 async def log_cache_size():
     while True:
         try:
+            if not logger.isEnabledFor(logging.INFO):
+                # Обход всех кэшей ради подсчёта размера не нужен, если строку всё равно не выведут
+                await asyncio.sleep(3600)
+                continue
             movie_size = sys.getsizeof(MOVIE_DICT) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in MOVIE_DICT.items())
             user_size = sys.getsizeof(USER_DICT) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in USER_DICT.items())
-            join_requests_size = sys.getsizeof(JOIN_REQUESTS_DICT) + sum(sys.getsizeof(k) for k in JOIN_REQUESTS_DICT)
-            logger.info(f"Cache sizes: movies={movie_size/1024:.2f} KB, users={user_size/1024:.2f} KB, join_requests={join_requests_size/1024:.2f} KB")
+            join_requests_size = sys.getsizeof(JOIN_REQUESTS) + sum(sys.getsizeof(k) for k in JOIN_REQUESTS)
+            logger.info("Cache sizes: movies=%.2f KB, users=%.2f KB, join_requests=%.2f KB", movie_size/1024, user_size/1024, join_requests_size/1024)
             await asyncio.sleep(3600)
         except Exception as e:
-            logger.error(f"Error logging cache size: {e}")
+            logger.error("Error logging cache size: %s", e)
             await asyncio.sleep(3600)
 
+async def log_lookup_stats():
+    global MOVIE_LOOKUP_HITS, MOVIE_LOOKUP_MISSES
+    while True:
+        await asyncio.sleep(LOOKUP_STATS_INTERVAL)
+        if MOVIE_LOOKUP_HITS or MOVIE_LOOKUP_MISSES:
+            logger.info("Movie lookups in last %ss: hits=%s misses=%s", LOOKUP_STATS_INTERVAL, MOVIE_LOOKUP_HITS, MOVIE_LOOKUP_MISSES)
+            MOVIE_LOOKUP_HITS = 0
+            MOVIE_LOOKUP_MISSES = 0
+
 async def refresh_movie_cache_periodically():
     while True:
         try:
             await load_movie_cache()
             await asyncio.sleep(MOVIE_CACHE_REFRESH_INTERVAL)
         except Exception as e:
-            logger.error(f"Error during movie cache refresh: {e}")
+            logger.error("Error during movie cache refresh: %s", e)
             await asyncio.sleep(MOVIE_CACHE_REFRESH_INTERVAL)
 
 async def refresh_other_caches_periodically():
@@ -231,166 +352,270 @@ async def refresh_other_caches_periodically():
             await load_join_requests_cache()
             await asyncio.sleep(OTHER_CACHE_REFRESH_INTERVAL)
         except Exception as e:
-            logger.error(f"Error during other caches refresh: {e}")
+            logger.error("Error during other caches refresh: %s", e)
             await asyncio.sleep(OTHER_CACHE_REFRESH_INTERVAL)
 
-application_tg = Application.builder().token(TOKEN).build()
-
-POSITIVE_EMOJIS = ['😍', '🎉', '😎', '👍', '🔥', '😊', '😁', '⭐']
+# AIORateLimiter держит глобальный и групповой лимиты Telegram и сам повторяет запросы после RetryAfter
+# Один пул соединений с HTTP/2: параллельные get_chat_member и ответы идут по уже открытым соединениям
+telegram_request = HTTPXRequest(
+    connection_pool_size=64,
+    http_version="2",
+    connect_timeout=5.0,
+    read_timeout=20.0
+)
+application_tg = (
+    Application.builder()
+    .token(TOKEN)
+    .request(telegram_request)
+    .rate_limiter(AIORateLimiter(max_retries=5))
+    .concurrent_updates(MAX_CONCURRENT_UPDATES)
+    .build()
+)
 
-def get_main_reply_keyboard():
-    keyboard = [
+POSITIVE_EMOJIS = ('😍', '🎉', '😎', '👍', '🔥', '😊', '😁', '⭐')
+POSITIVE_EMOJI_CYCLE = itertools.cycle(random.sample(POSITIVE_EMOJIS, len(POSITIVE_EMOJIS)))
+
+CONFIRM_SUBSCRIPTION_BUTTON = InlineKeyboardButton("✅ Я ПОДПИСАЛСЯ!", callback_data="check_subscription")
+CONFIRM_SUBSCRIPTION_ROW = (CONFIRM_SUBSCRIPTION_BUTTON,)
+# Ряды клавиатуры с кнопками каналов создаются один раз; неполная клавиатура собирается из готовых рядов
+CHANNEL_BUTTON_ROWS = tuple((InlineKeyboardButton(btn["text"], url=btn["url"]),) for btn in CHANNEL_BUTTONS)
+SUBSCRIBE_KEYBOARD = InlineKeyboardMarkup(CHANNEL_BUTTON_ROWS + (CONFIRM_SUBSCRIPTION_ROW,))
+# Пары (канал, ряд с кнопкой) собираются один раз, а не zip'ом на каждой проверке подписки
+CHANNEL_PAIRS = tuple(zip(CHANNELS, CHANNEL_BUTTON_ROWS))
+MAIN_REPLY_KEYBOARD = ReplyKeyboardMarkup(
+    [
         [KeyboardButton("🔍 Поиск фильма"), KeyboardButton("👥 Реферальная система")],
         [KeyboardButton("❓ Как работает бот")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
-
-def get_search_reply_keyboard():
-    keyboard = [
-        [KeyboardButton("❌ Назад")]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
+SEARCH_REPLY_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton("❌ Назад")]], resize_keyboard=True, one_time_keyboard=False)
 
-def escape_markdown_v2(text: str) -> str:
-    special_chars = r'_*[]()~`>#+-=|{}.!'
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
-    return text
+# Тексты сообщений собраны заранее, в обработчиках подставляются только переменные части
+WELCOME_TEXT = (
+    "Привет, *киноман*! 🎬\n"
+    "Добро пожаловать в твой личный кино-гид! 🍿 Я помогу найти фильмы по секретным кодам и открою мир кино! 🚀\n"
+    "Выбери действие в меню ниже, и начнём приключение! 😎"
+)
+WELCOME_REFERRAL_TEXT = (
+    "Привет, *киноман*! 🎬\n"
+    "Добро пожаловать в твой личный кино-гид! 🍿 Я помогу найти фильмы по секретным кодам и открою мир кино! 🚀\n"
+    "Ты был приглашён другом! 😎 "
+    "Выбери действие в меню ниже, и начнём приключение! 😎"
+)
+SELF_INVITE_TEXT = "❌ Вы не можете пригласить себя!"
+SUBSCRIBE_PROMPT_TEXT = (
+    "Эй, *кинофан*! 🎥\n"
+    "Чтобы открыть доступ к фильмам, подпишись на наших крутых спонсоров! 🌟\n"
+    "Кликни на кнопки ниже, подпишись или отправь заявку на вступление и нажми *Я ПОДПИСАЛСЯ!* 😎"
+)
+MISSING_CHANNELS_TEXT = (
+    "Ой-ой! 😜 Похоже, ты пропустил пару каналов! 🚨\n"
+    "Подпишись или отправь заявку на вступление на все каналы ниже и снова нажми *Я ПОДПИСАЛСЯ!* 🌟"
+)
+SUBSCRIPTION_SUCCESS_TEXT = (
+    "Супер, *ты в деле*! 🎉\n"
+    "Вы подписаны на все каналы или отправили заявки! 😍 Теперь ты можешь искать фильмы!\n"
+    "Нажми *🔍 Поиск фильма* в меню ниже! 😎"
+)
+SUBSCRIPTION_SUCCESS_SEARCH_TEXT = (
+    "Супер, *ты в деле*! 🎉\n"
+    "Вы подписаны на все каналы или отправили заявки! 😍 Теперь ты можешь искать фильмы!\n"
+    "Введи *числовой код* для поиска фильма! 🍿"
+)
+REFERRAL_REWARD_TEXT = "Пользователь {user_id} успешно подтвердил подписку. Вам начислено *+2 поиска*!"
+USER_DATA_ERROR_TEXT = "Упс, не удалось получить твои данные! 😢 Перезапусти бота."
+SEARCH_NOT_STARTED_TEXT = "Эй, *киноман*! 😅 Сначала нажми *🔍 Поиск фильма*, а потом введи код! 🍿"
+NO_SEARCHES_LEFT_TEXT = "Ой, у тебя закончились поиски! 😕 Приглашай друзей через *👥 Реферальная система* и получай +2 поиска за каждого! 🚀"
+# Результаты поиска в HTML: название из таблицы экранируется html.escape и не ломает разметку
+MOVIE_FOUND_TEXT = (
+    "<b>Бинго!</b> 🎥 Код {code}: <b>{title}</b> {emoji}\n"
+    "Осталось поисков: <b>{remaining}</b> 🔍\n"
+    "Хочешь найти ещё один шедевр? Нажми <b>🔍 Поиск фильма</b>! 🍿"
+)
+MOVIE_NOT_FOUND_TEXT = "Упс, фильм с кодом <b>{code}</b> не найден! 😢 Проверь код или попробуй другой! 🔍"
+SEARCH_PROMPT_TEXT = "Отлично! 😎 Введи *числовой код* фильма, и я найду его для тебя! 🍿"
+SEARCH_CANCELLED_TEXT = "Поиск отменён! 😊 Выбери действие в меню ниже! 👇"
+UNKNOWN_COMMAND_TEXT = "Ой, *неизвестная команда*! 😕 Пожалуйста, выбери действие из меню ниже! 👇"
+REFERRAL_TEXT = (
+    "<b>🔥 Реферальная система 🔥</b>\n\n"
+    "Приглашай друзей и получай <b>+2 поиска</b> за каждого, кто перейдёт по твоей ссылке и подпишется на наши каналы! 🚀\n\n"
+    "Твоя реферальная ссылка:\n<a href='{referral_link}'>{referral_link}</a>\n"
+    "Копируй свою реферальную ссылку и зови друзей! 😎\n\n"
+    "👥 <b>Количество добавленных пользователей</b>: <b>{invited_users}</b>\n"
+    "🔍 <b>Количество оставшихся запросов</b>: <b>{search_queries}</b>"
+)
+HOW_IT_WORKS_TEXT = (
+    "🎬 *Как работает наш кино-бот?* 🎥\n\n"
+    "Я — твой личный помощник в мире кино! 🍿 Моя главная задача — помочь тебе найти фильмы по секретным числовым кодам. Вот как это работает:\n\n"
+    "🔍 *Поиск фильмов*:\n"
+    "1. Нажми на кнопку *🔍 Поиск фильма* в меню.\n"
+    "2. Подпишись на наши крутые спонсорские каналы или отправь заявку на вступление (это обязательно для поиска! 😎).\n"
+    "3. Введи *числовой код* фильма (только цифры!).\n"
+    "4. Я найду фильм в нашей базе и покажу его название! 🎉\n\n"
+    "👥 *Реферальная система*:\n"
+    "- Чтобы получить реферальную ссылку, подпишись на наши каналы! 🌟\n"
+    "- У тебя есть *5 бесплатных поисков* при старте! 🚀\n"
+    "- Приглашай друзей в бота, и за каждого, кто подпишется на каналы, ты получишь *+2 поиска*! 😍\n"
+    "- Если поиски закончились, приглашай друзей, чтобы продолжить! 🚀\n\n"
+    "❗ *Важно*:\n"
+    "- Подписка или заявка на вступление в каналы обязательна для поиска фильмов и использования реферальной системы.\n"
+    "- Вводи только числовые коды после нажатия *🔍 Поиск фильма*.\n"
+    "- Нажми *❌ Назад*, чтобы отменить поиск и вернуться в меню.\n"
+    "- Если что-то пошло не так, просто следуй подсказкам, и я помогу! 😊\n\n"
+    "Готов к кино-приключению? Выбери действие в меню! 👇"
+)
+ALREADY_SUBSCRIBED_TEXT = "Ты уже подписан! 😎"
+THROTTLED_TEXT = "Не так быстро! 😅 Подожди секунду и попробуй снова."
+ERROR_TEXT = "Упс, что-то пошло не так! 😢 Попробуй снова."
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.message.from_user
     user_id = user.id
     username = user.username or ""
     first_name = user.first_name or ""
-    logger.info(f"User {user_id} {first_name} started the bot with message: {update.message.text}")
+    logger.debug("User %s %s started the bot with message: %s", user_id, first_name, update.message.text)
 
     referrer_id = None
-    if update.message.text.startswith("/start invite_"):
+    text = update.message.text
+    if text.startswith(INVITE_PREFIX):
         try:
-            referrer_id = int(update.message.text.split("invite_")[1])
+            referrer_id = int(text[len(INVITE_PREFIX):])
             if referrer_id == user_id:
-                logger.info(f"User {user_id} tried to invite themselves.")
-                await send_message_with_retry(update.message, "❌ Вы не можете пригласить себя!", reply_markup=get_main_reply_keyboard())
+                logger.info("User %s tried to invite themselves.", user_id)
+                await send_message_with_retry(update.message, SELF_INVITE_TEXT, reply_markup=MAIN_REPLY_KEYBOARD, parse_mode=None)
                 return
-            logger.info(f"Referral detected for user {user_id} from referrer {referrer_id}")
-            context.user_data['referrer_id'] = referrer_id
-        except (IndexError, ValueError):
-            logger.warning(f"Invalid referral link for user {user_id}: {update.message.text}")
+        except ValueError:
+            logger.warning("Invalid referral link for user %s: %s", user_id, text)
             referrer_id = None
 
-    user_data = get_user_data(user_id)
-    if not user_data:
-        try:
-            await add_user(user_id, username, first_name, search_queries=5, invited_users=0)
-            logger.info(f"Added user {user_id} to Users sheet with 5 search queries.")
-            await load_user_cache()  # Обновляем кэш после добавления
-        except Exception as e:
-            logger.error(f"Failed to add user {user_id} to Users sheet: {e}")
-    else:
-        try:
-            await update_user(user_id, username=username, first_name=first_name)
-            logger.info(f"Updated existing user {user_id}.")
-        except Exception as e:
-            logger.error(f"Failed to update user {user_id}: {e}")
+    try:
+        _, is_new = await get_or_create_user(user_id, username, first_name)
+    except Exception as e:
+        logger.error("Failed to register user %s: %s", user_id, e)
+        is_new = False
 
-    welcome_text = (
-        "Привет, *киноман*! 🎬\n"
-        "Добро пожаловать в твой личный кино-гид! 🍿 Я помогу найти фильмы по секретным кодам и открою мир кино! 🚀\n"
-        f"{'Ты был приглашён другом! 😎 ' if referrer_id else ''}"
-        "Выбери действие в меню ниже, и начнём приключение! 😎"
-    )
-    await send_message_with_retry(update.message, welcome_text, reply_markup=get_main_reply_keyboard())
+    if referrer_id:
+        # Реферал засчитывается только за нового пользователя
+        if is_new:
+            logger.info("Referral detected for user %s from referrer %s", user_id, referrer_id)
+            context.user_data['referrer_id'] = referrer_id
+        else:
+            logger.debug("Ignoring referral from %s for existing user %s", referrer_id, user_id)
+            referrer_id = None
 
+    welcome_text = WELCOME_REFERRAL_TEXT if referrer_id else WELCOME_TEXT
+    await send_message_with_retry(update.message, welcome_text, reply_markup=MAIN_REPLY_KEYBOARD)
 
-async def send_message_with_retry(message, text: str, reply_markup=None, parse_mode: str = 'Markdown') -> None:
+
+async def antiflood(func, *args, retry_timeouts: bool = False, **kwargs):
+    # RetryAfter обрабатывает AIORateLimiter; здесь только сетевые сбои с растущей паузой
+    delay = NETWORK_RETRY_DELAY
+    for attempt in range(1, NETWORK_RETRY_ATTEMPTS + 1):
+        try:
+            return await func(*args, **kwargs)
+        except BadRequest:
+            # BadRequest — подкласс NetworkError, но повтор того же запроса ничего не изменит
+            raise
+        except TimedOut:
+            # После таймаута запрос мог дойти: повтор отправки продублирует сообщение, повтор правки безопасен
+            if not retry_timeouts or attempt == NETWORK_RETRY_ATTEMPTS:
+                raise
+            logger.warning("Request timed out. Retrying in %s seconds.", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, NETWORK_RETRY_MAX_DELAY)
+        except NetworkError as e:
+            if attempt == NETWORK_RETRY_ATTEMPTS:
+                raise
+            logger.warning("Network error: %s. Retrying in %s seconds.", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, NETWORK_RETRY_MAX_DELAY)
+
+async def send_message_with_retry(message, text: str, reply_markup=None, parse_mode: Optional[str] = 'Markdown') -> None:
     try:
-        await message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
-    except RetryAfter as e:
-        logger.warning(f"Flood control triggered: {e}. Waiting {e.retry_after} seconds.")
-        await asyncio.sleep(e.retry_after)
-        await message.reply_text(text, parse_mode=parse_mode, reply_markup=reply_markup)
-    except Exception as e:
-        logger.error(f"Failed to send message: {e}, Response: {e.__dict__}")
+        await antiflood(message.reply_text, text, parse_mode=parse_mode, reply_markup=reply_markup)
+    except BadRequest as e:
+        logger.error("Failed to send message: %s, Response: %s", e, e.__dict__)
         try:
-            await message.reply_text(text, reply_markup=reply_markup)
+            await antiflood(message.reply_text, text, reply_markup=reply_markup)
         except Exception as e2:
-            logger.error(f"Failed to send message without parse_mode: {e2}")
+            logger.error("Failed to send message without parse_mode: %s", e2)
+    except Exception as e:
+        logger.error("Failed to send message: %s", e)
 
 async def edit_message_with_retry(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
     try:
-        await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=text,
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-    except RetryAfter as e:
-        logger.warning(f"Flood control triggered: {e}. Waiting {e.retry_after} seconds.")
-        await asyncio.sleep(e.retry_after)
-        await context.bot.edit_message_text(
+        await antiflood(
+            context.bot.edit_message_text,
+            retry_timeouts=True,
             chat_id=chat_id,
             message_id=message_id,
             text=text,
             parse_mode='Markdown',
             reply_markup=reply_markup
         )
-    except Exception as e:
-        logger.error(f"Failed to edit message: {e}, Response: {e.__dict__}")
+    except BadRequest as e:
+        logger.error("Failed to edit message: %s, Response: %s", e, e.__dict__)
         try:
-            await context.bot.edit_message_text(
+            await antiflood(
+                context.bot.edit_message_text,
+                retry_timeouts=True,
                 chat_id=chat_id,
                 message_id=message_id,
                 text=text,
                 reply_markup=reply_markup
             )
         except Exception as e2:
-            logger.error(f"Failed to edit message without Markdown: {e2}")
+            logger.error("Failed to edit message without Markdown: %s", e2)
+    except Exception as e:
+        logger.error("Failed to edit message: %s", e)
 
 async def prompt_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE, message_id: Optional[int] = None) -> None:
-    promo_text = (
-        "Эй, *кинофан*! 🎥\n"
-        "Чтобы открыть доступ к фильмам, подпишись на наших крутых спонсоров! 🌟\n"
-        "Кликни на кнопки ниже, подпишись или отправь заявку на вступление и нажми *Я ПОДПИСАЛСЯ!* 😎"
-    )
-    keyboard = [[InlineKeyboardButton(btn["text"], url=btn["url"])] for btn in CHANNEL_BUTTONS]
-    keyboard.append([InlineKeyboardButton("✅ Я ПОДПИСАЛСЯ!", callback_data="check_subscription")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     if message_id:
-        await edit_message_with_retry(context, update.effective_chat.id, message_id, promo_text, reply_markup)
+        await edit_message_with_retry(context, update.effective_chat.id, message_id, SUBSCRIBE_PROMPT_TEXT, SUBSCRIBE_KEYBOARD)
     else:
-        await send_message_with_retry(update.message, promo_text, reply_markup=reply_markup)
+        await send_message_with_retry(update.message, SUBSCRIBE_PROMPT_TEXT, reply_markup=SUBSCRIBE_KEYBOARD)
 
 def has_sent_join_request(user_id: int, channel_id: int) -> bool:
-    return (str(user_id), str(channel_id)) in JOIN_REQUESTS_DICT
+    return (str(user_id), str(channel_id)) in JOIN_REQUESTS
 
 async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer()
     user_id = query.from_user.id
+    checked_at = context.user_data.get('subscription_checked_at', 0)
+    if context.user_data.get('subscription_confirmed', False) and time.monotonic() - checked_at < SUBSCRIPTION_RECHECK_TTL:
+        # Подписку только что подтвердили — повторный клик не гоняет get_chat_member по всем каналам
+        await query.answer(ALREADY_SUBSCRIBED_TEXT)
+        return
+    await query.answer()
     bot = context.bot
     unsubscribed_channels = []
 
-    for channel_id, button in zip(CHANNELS, CHANNEL_BUTTONS):
-        try:
-            member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-            if member.status in ["member", "administrator", "creator"]:
-                continue
-            elif has_sent_join_request(user_id, channel_id):
-                continue
-            else:
-                unsubscribed_channels.append(button)
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Error checking subscription for channel {channel_id}: {e}")
-            unsubscribed_channels.append(button)
+    pending = [pair for pair in CHANNEL_PAIRS if (user_id, pair[0]) not in SUBSCRIPTION_CACHE]
+    results = await asyncio.gather(
+        *(bot.get_chat_member(chat_id=channel_id, user_id=user_id) for channel_id, _ in pending),
+        return_exceptions=True
+    )
+    for (channel_id, button_row), member in zip(pending, results):
+        if isinstance(member, Exception):
+            logger.error("Error checking subscription for channel %s: %s", channel_id, member)
+            unsubscribed_channels.append(button_row)
+        elif member.status in MEMBER_STATUSES:
+            SUBSCRIPTION_CACHE[(user_id, channel_id)] = True
+        elif has_sent_join_request(user_id, channel_id):
+            continue
+        else:
+            unsubscribed_channels.append(button_row)
 
     if not unsubscribed_channels:
         context.user_data['subscription_confirmed'] = True
-        logger.info(f"User {user_id} successfully confirmed subscription for all channels.")
+        context.user_data['subscription_checked_at'] = time.monotonic()
+        # Забираем реферера до первого await: при параллельном повторном клике награда не начислится дважды
+        referrer_id = context.user_data.pop('referrer_id', None)
+        await update_user(user_id, subscribed_at=int(time.time()))
+        logger.info("User %s successfully confirmed subscription for all channels.", user_id)
 
-        referrer_id = context.user_data.get('referrer_id')
         if referrer_id:
             referrer_data = get_user_data(referrer_id)
             if referrer_data:
@@ -401,25 +626,19 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
                     invited_users=new_invited_users,
                     search_queries=new_search_queries
                 )
-                logger.info(f"Added 2 search queries to referrer {referrer_id} for inviting user {user_id}")
+                logger.info("Added 2 search queries to referrer %s for inviting user %s", referrer_id, user_id)
                 try:
-                    await bot.send_message(
-                        user_id=referrer_id,
-                        text=f"Пользователь {user_id} успешно подтвердил подписку. Вам начислено *+2 поиска*!",
+                    await antiflood(
+                        bot.send_message,
+                        chat_id=referrer_id,
+                        text=REFERRAL_REWARD_TEXT.format(user_id=user_id),
                         parse_mode='Markdown'
                     )
-                    logger.info(f"Sent referral reward notification to referrer {referrer_id}")
+                    logger.info("Sent referral reward notification to referrer %s", referrer_id)
                 except Exception as e:
-                    logger.error(f"Failed to send referral reward notification to {referrer_id}: {e}")
-
-                del context.user_data['referrer_id']
+                    logger.error("Failed to send referral reward notification to %s: %s", referrer_id, e)
 
-        success_text = (
-            "Супер, *ты в деле*! 🎉\n"
-            "Вы подписаны на все каналы или отправили заявки! 😍 Теперь ты можешь искать фильмы!\n"
-            f"{'Введи *числовой код* для поиска фильма! 🍿' if context.user_data.get('awaiting_code', False) else 'Нажми *🔍 Поиск фильма* в меню ниже! 😎'}"
-        )
-        reply_markup = get_main_reply_keyboard() if not context.user_data.get('awaiting_code', False) else get_search_reply_keyboard()
+        success_text = SUBSCRIPTION_SUCCESS_SEARCH_TEXT if context.user_data.get('awaiting_code', False) else SUBSCRIPTION_SUCCESS_TEXT
 
         await asyncio.sleep(0.5)
         await edit_message_with_retry(
@@ -431,144 +650,241 @@ async def check_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
 
     else:
-        logger.info(f"User {user_id} is not subscribed to some channels.")
-        promo_text = (
-            "Ой-ой! 😜 Похоже, ты пропустил пару каналов! 🚨\n"
-            "Подпишись или отправь заявку на вступление на все каналы ниже и снова нажми *Я ПОДПИСАЛСЯ!* 🌟"
-        )
-        keyboard = [[InlineKeyboardButton(btn["text"], url=btn["url"])] for btn in unsubscribed_channels]
-        keyboard.append([InlineKeyboardButton("✅ Я ПОДПИСАЛСЯ!", callback_data="check_subscription")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        logger.debug("User %s is not subscribed to some channels.", user_id)
+        if len(unsubscribed_channels) == len(CHANNEL_PAIRS):
+            reply_markup = SUBSCRIBE_KEYBOARD
+        else:
+            unsubscribed_channels.append(CONFIRM_SUBSCRIPTION_ROW)
+            reply_markup = InlineKeyboardMarkup(unsubscribed_channels)
         await edit_message_with_retry(
             context,
             query.message.chat_id,
             query.message.message_id,
-            promo_text,
+            MISSING_CHANNELS_TEXT,
             reply_markup=reply_markup
         )
 
 def get_user_data(user_id: int) -> Optional[Dict[str, str]]:
     return USER_DICT.get(str(user_id))
 
+def is_subscription_confirmed(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    if context.user_data.get('subscription_confirmed', False):
+        return True
+    # После рестарта user_data пуст — недавнее подтверждение берём из кэша листа Users
+    user_data = get_user_data(user_id)
+    subscribed_at = user_data.get("subscribed_at") if user_data else ""
+    if subscribed_at and subscribed_at.isdigit() and time.time() - int(subscribed_at) < SUBSCRIPTION_RESTORE_TTL:
+        context.user_data['subscription_confirmed'] = True
+        return True
+    return False
+
 async def add_user(user_id: int, username: str, first_name: str, search_queries: int, invited_users: int) -> None:
     if user_sheet is None:
         logger.error("Users sheet not initialized.")
         return
-    try:
-        user_id_str = str(user_id)
-        row_to_add = [user_id_str, username, first_name, str(search_queries), str(invited_users)]
-        await user_sheet.append_row(row_to_add)
-        USER_DICT[user_id_str] = {
-            "user_id": user_id_str,
-            "username": username,
-            "first_name": first_name,
-            "search_queries": str(search_queries),
-            "invited_users": str(invited_users)
-        }
-        logger.info(f"Added user {user_id} to Users sheet with {search_queries} search queries.")
-    except Exception as e:
-        logger.error(f"Failed to add user {user_id} to Users sheet: {e}")
+    user_id_str = str(user_id)
+    row_to_add = [user_id_str, username, first_name, str(search_queries), str(invited_users), ""]
+    PENDING_USER_APPENDS[user_id_str] = row_to_add
+    USER_DICT[user_id_str] = user_record(row_to_add)
+    logger.debug("Queued user %s for Users sheet with %s search queries.", user_id, search_queries)
 
 async def update_user(user_id: int, **kwargs) -> None:
     if user_sheet is None:
         logger.error("Users sheet not initialized.")
         return
-    try:
-        user_id_str = str(user_id)
-        all_values = await user_sheet.get_all_values()
-        logger.info(f"Searching for user {user_id_str} in Users sheet. Total rows: {len(all_values)}")
-        for idx, row in enumerate(all_values[1:], start=2):
-            if not row or len(row) < 1 or row[0] != user_id_str:
-                continue
-            updates = {
-                "username": row[1] if len(row) > 1 else "",
-                "first_name": row[2] if len(row) > 2 else "",
-                "search_queries": row[3] if len(row) > 3 else "0",
-                "invited_users": row[4] if len(row) > 4 else "0"
-            }
-            updates.update(kwargs)
-            logger.info(f"Updating user {user_id_str} with new values: {updates}")
-            await user_sheet.update(f"A{idx}:E{idx}", [[
-                user_id_str,
-                updates["username"],
-                updates["first_name"],
-                str(updates["search_queries"]),
-                str(updates["invited_users"])
-            ]])
-            USER_DICT[user_id_str] = {
-                "user_id": user_id_str,
-                "username": updates["username"],
-                "first_name": updates["first_name"],
-                "search_queries": str(updates["search_queries"]),
-                "invited_users": str(updates["invited_users"])
-            }
-            logger.info(f"Successfully updated user {user_id} in Users sheet and cache.")
-            await load_user_cache()  # Принудительно обновляем кэш
+    user_id_str = str(user_id)
+    cached = USER_DICT.get(user_id_str)
+    if cached is None:
+        logger.warning("User %s not found in Users sheet for update.", user_id)
+        return
+    updates = dict(cached)
+    updates.update(kwargs)
+    row = [
+        user_id_str,
+        updates["username"],
+        updates["first_name"],
+        str(updates["search_queries"]),
+        str(updates["invited_users"]),
+        str(updates["subscribed_at"])
+    ]
+    # Пользователь ещё не добавлен в таблицу — достаточно заменить строку в очереди на добавление
+    if user_id_str in PENDING_USER_APPENDS:
+        PENDING_USER_APPENDS[user_id_str] = row
+    else:
+        PENDING_USER_UPDATES[user_id_str] = row
+    USER_DICT[user_id_str] = user_record(row)
+    logger.debug("Queued update for user %s: %s", user_id_str, updates)
+
+async def get_or_create_user(user_id: int, username: str, first_name: str) -> Tuple[Dict[str, str], bool]:
+    # Между проверкой и добавлением нет await: два параллельных /start не зарегистрируют пользователя дважды
+    user_data = get_user_data(user_id)
+    if user_data is None:
+        await add_user(user_id, username, first_name, search_queries=5, invited_users=0)
+        logger.info("Registered new user %s with 5 search queries.", user_id)
+        return get_user_data(user_id), True
+    if user_data["username"] != username or user_data["first_name"] != first_name:
+        await update_user(user_id, username=username, first_name=first_name)
+    return user_data, False
+
+async def acquire_sheet_write() -> None:
+    global SHEET_WRITE_TOKENS, SHEET_WRITE_CHECKED_AT
+    rate = SHEET_WRITES_PER_MINUTE / 60
+    while True:
+        now = time.monotonic()
+        SHEET_WRITE_TOKENS = min(SHEET_WRITE_BURST, SHEET_WRITE_TOKENS + (now - SHEET_WRITE_CHECKED_AT) * rate)
+        SHEET_WRITE_CHECKED_AT = now
+        if SHEET_WRITE_TOKENS >= 1:
+            SHEET_WRITE_TOKENS -= 1
             return
-        logger.warning(f"User {user_id} not found in Users sheet for update.")
-    except Exception as e:
-        logger.error(f"Failed to update user {user_id}: {e}")
+        await asyncio.sleep((1 - SHEET_WRITE_TOKENS) / rate)
+
+def take_pending_batch(pending: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    # Не больше SHEET_MAX_BATCH_ROWS строк за запрос; остаток уйдёт при следующей выгрузке
+    batch = dict(itertools.islice(pending.items(), SHEET_MAX_BATCH_ROWS))
+    for uid in batch:
+        del pending[uid]
+    return batch
+
+async def flush_user_writes() -> None:
+    if user_sheet is None:
+        return
+    async with USER_SHEET_LOCK:
+        if PENDING_USER_APPENDS:
+            # Пачку забираем из очереди только после получения токена, чтобы она не терялась во время ожидания
+            await acquire_sheet_write()
+            appends = take_pending_batch(PENDING_USER_APPENDS)
+            try:
+                response = await user_sheet.append_rows(list(appends.values()))
+            except BaseException as e:
+                logger.error("Failed to append %s users to Users sheet: %s", len(appends), e)
+                for uid, row in appends.items():
+                    # Изменения, пришедшие во время записи, новее строки из очереди — добавляем уже их
+                    if uid not in PENDING_USER_APPENDS:
+                        PENDING_USER_APPENDS[uid] = PENDING_USER_UPDATES.pop(uid, row)
+                # Отменённая запись (остановка бота) тоже возвращается в очередь, но отмена идёт дальше
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+            else:
+                first_row = parse_appended_row(response or {})
+                if first_row:
+                    USER_ROWS.update((uid, first_row + i) for i, uid in enumerate(appends))
+                else:
+                    logger.warning("Could not determine sheet rows for %s new users; they will be picked up on the next cache refresh.", len(appends))
+                logger.info("Appended %s users to Users sheet.", len(appends))
+
+        if PENDING_USER_UPDATES:
+            await acquire_sheet_write()
+            updates = take_pending_batch(PENDING_USER_UPDATES)
+            data = []
+            for uid, row in updates.items():
+                idx = USER_ROWS.get(uid)
+                if idx is None:
+                    # Номер строки ещё неизвестен — изменение ждёт следующей загрузки кэша, а не теряется
+                    logger.warning("Row for user %s is not known yet; keeping the update queued.", uid)
+                    PENDING_USER_UPDATES.setdefault(uid, row)
+                    continue
+                data.append({"range": f"A{idx}:F{idx}", "values": [row]})
+            if not data:
+                return
+            try:
+                await user_sheet.batch_update(data)
+                logger.info("Updated %s users in Users sheet.", len(data))
+            except BaseException as e:
+                logger.error("Failed to update %s users in Users sheet: %s", len(data), e)
+                for uid, row in updates.items():
+                    PENDING_USER_UPDATES.setdefault(uid, row)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+
+def pending_sheet_rows() -> int:
+    return len(PENDING_USER_APPENDS) + len(PENDING_USER_UPDATES) + len(PENDING_JOIN_REQUESTS)
+
+async def flush_sheet_writes():
+    await flush_user_writes()
+    await flush_join_requests()
+
+async def flush_sheet_writes_periodically():
+    while True:
+        await asyncio.sleep(SHEET_FLUSH_INTERVAL)
+        try:
+            await flush_sheet_writes()
+        except Exception as e:
+            logger.error("Error flushing sheet writes: %s", e)
 
 
 async def add_join_request(user_id: int, channel_id: int) -> None:
     if join_requests_sheet is None:
         logger.error("JoinRequests sheet not initialized.")
         return
-    try:
-        user_id_str, channel_id_str = str(user_id), str(channel_id)
-        if (user_id_str, channel_id_str) in JOIN_REQUESTS_DICT:
+    key = (str(user_id), str(channel_id))
+    if key in JOIN_REQUESTS:
+        return
+    # Заявка учитывается сразу, а в таблицу уходит вместе с остальными при очередной выгрузке
+    JOIN_REQUESTS.add(key)
+    PENDING_JOIN_REQUESTS.append(list(key))
+    logger.info("Queued join request for user %s to channel %s", user_id, channel_id)
+
+async def flush_join_requests() -> None:
+    if join_requests_sheet is None:
+        return
+    async with JOIN_REQUESTS_LOCK:
+        if not PENDING_JOIN_REQUESTS:
             return
-        await join_requests_sheet.append_row([user_id_str, channel_id_str])
-        JOIN_REQUESTS_DICT[(user_id_str, channel_id_str)] = True
-        if len(JOIN_REQUESTS_DICT) > 10000:
-            oldest_key = next(iter(JOIN_REQUESTS_DICT))
-            del JOIN_REQUESTS_DICT[oldest_key]
-        logger.info(f"Added join request for user {user_id} to channel {channel_id}")
-    except Exception as e:
-        logger.error(f"Failed to add join request for user {user_id} to channel {channel_id}: {e}")
+        await acquire_sheet_write()
+        rows = PENDING_JOIN_REQUESTS[:SHEET_MAX_BATCH_ROWS]
+        del PENDING_JOIN_REQUESTS[:SHEET_MAX_BATCH_ROWS]
+        try:
+            await join_requests_sheet.append_rows(rows)
+            logger.info("Appended %s join requests to JoinRequests sheet.", len(rows))
+        except BaseException as e:
+            logger.error("Failed to append %s join requests: %s", len(rows), e)
+            PENDING_JOIN_REQUESTS[:0] = rows
+            if isinstance(e, asyncio.CancelledError):
+                raise
 
 def find_movie_by_code(code: str) -> Optional[Dict[str, str]]:
-    if code in MOVIE_DICT:
-        return {"code": code, "title": MOVIE_DICT[code]}
-    return None
+    global MOVIE_LOOKUP_HITS, MOVIE_LOOKUP_MISSES
+    title = MOVIE_DICT.get(code)
+    if title is None:
+        MOVIE_LOOKUP_MISSES += 1
+        logger.debug("Movie with code %s not found in cache.", code)
+        return None
+    MOVIE_LOOKUP_HITS += 1
+    logger.debug("Found movie for code %s: %s", code, title)
+    return {"code": code, "title": title}
 
 async def handle_movie_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    code = update.message.text.strip()
+    code = update.message.text
     user_id = update.message.from_user.id
 
     if not context.user_data.get('awaiting_code', False):
-        logger.info(f"User {user_id} sent code without activating search mode.")
-        await send_message_with_retry(update.message, "Эй, *киноман*! 😅 Сначала нажми *🔍 Поиск фильма*, а потом введи код! 🍿", reply_markup=get_main_reply_keyboard())
-        return
-
-    if not code.isdigit():
-        logger.info(f"User {user_id} entered non-numeric code: {code}")
-        await send_message_with_retry(update.message, "Ой, нужен *только числовой код*! 😊 Введи цифры, и мы найдём твой фильм! 🔢", reply_markup=get_search_reply_keyboard())
+        logger.debug("User %s sent code without activating search mode.", user_id)
+        await send_message_with_retry(update.message, SEARCH_NOT_STARTED_TEXT, reply_markup=MAIN_REPLY_KEYBOARD)
         return
 
     user_data = get_user_data(user_id)
     if not user_data:
-        logger.error(f"User {user_id} not found in Users sheet.")
-        await send_message_with_retry(update.message, "Упс, не удалось получить твои данные! 😢 Перезапусти бота.", reply_markup=get_main_reply_keyboard())
+        logger.error("User %s not found in Users sheet.", user_id)
+        await send_message_with_retry(update.message, USER_DATA_ERROR_TEXT, reply_markup=MAIN_REPLY_KEYBOARD, parse_mode=None)
         return
 
     # Проверка на безлимитные запросы
     if user_id not in UNLIMITED_USERS:
         search_queries = int(user_data.get("search_queries", 0))
         if search_queries <= 0:
-            logger.info(f"User {user_id} has no remaining search queries.")
+            logger.debug("User %s has no remaining search queries.", user_id)
             await send_message_with_retry(
                 update.message,
-                "Ой, у тебя закончились поиски! 😕 Приглашай друзей через *👥 Реферальная система* и получай +2 поиска за каждого! 🚀",
-                reply_markup=get_main_reply_keyboard()
+                NO_SEARCHES_LEFT_TEXT,
+                reply_markup=MAIN_REPLY_KEYBOARD
             )
             context.user_data['awaiting_code'] = False
             return
     else:
         search_queries = None  # Для безлимитных пользователей search_queries не используется
-        logger.info(f"User {user_id} has unlimited search queries.")
+        logger.debug("User %s has unlimited search queries.", user_id)
 
-    logger.info(f"User {user_id} processing code: {code}")
+    logger.debug("User %s processing code: %s", user_id, code)
     movie = find_movie_by_code(code)
     context.user_data['awaiting_code'] = False
 
@@ -576,117 +892,121 @@ async def handle_movie_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Уменьшаем количество запросов только для обычных пользователей
         if user_id not in UNLIMITED_USERS:
             await update_user(user_id, search_queries=search_queries - 1)
-            result_text = (
-                f"*Бинго!* 🎥 Код {code}: *{escape_markdown_v2(movie['title'])}* {random.choice(POSITIVE_EMOJIS)}\n"
-                f"Осталось поисков: *{search_queries - 1}* 🔍\n"
-                "Хочешь найти ещё один шедевр? Нажми *🔍 Поиск фильма*! 🍿"
-            )
+            remaining = search_queries - 1
         else:
-            result_text = (
-                f"*Бинго!* 🎥 Код {code}: *{escape_markdown_v2(movie['title'])}* {random.choice(POSITIVE_EMOJIS)}\n"
-                f"Осталось поисков: *∞ (безлимит)* 🔍\n"
-                "Хочешь найти ещё один шедевр? Нажми *🔍 Поиск фильма*! 🍿"
-            )
+            remaining = "∞ (безлимит)"
+        result_text = MOVIE_FOUND_TEXT.format(
+            code=code,
+            title=html.escape(movie['title']),
+            emoji=next(POSITIVE_EMOJI_CYCLE),
+            remaining=remaining
+        )
     else:
-        result_text = f"Упс, фильм с кодом *{code}* не найден! 😢 Проверь код или попробуй другой! 🔍"
+        result_text = MOVIE_NOT_FOUND_TEXT.format(code=code)
 
-    await send_message_with_retry(update.message, result_text, reply_markup=get_main_reply_keyboard())
+    await send_message_with_retry(update.message, result_text, reply_markup=MAIN_REPLY_KEYBOARD, parse_mode='HTML')
 
 
-async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if update.message and update.message.from_user:
-        user_id = update.message.from_user.id
-        text = update.message.text
+async def handle_search_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data['awaiting_code'] = True
+    await send_message_with_retry(
+        update.message,
+        SEARCH_PROMPT_TEXT,
+        reply_markup=SEARCH_REPLY_KEYBOARD
+    )
 
-        if text == "🔍 Поиск фильма":
-            if not context.user_data.get('subscription_confirmed', False):
-                logger.info(f"User {user_id} pressed Search without subscription.")
-                await prompt_subscribe(update, context)
-                return
-            context.user_data['awaiting_code'] = True
-            await send_message_with_retry(
-                update.message,
-                "Отлично! 😎 Введи *числовой код* фильма, и я найду его для тебя! 🍿",
-                reply_markup=get_search_reply_keyboard()
-            )
-        elif text == "❌ Назад":
-            if context.user_data.get('awaiting_code', False):
-                context.user_data['awaiting_code'] = False
-                logger.info(f"User {user_id} cancelled search mode.")
-                await send_message_with_retry(
-                    update.message,
-                    "Поиск отменён! 😊 Выбери действие в меню ниже! 👇",
-                    reply_markup=get_main_reply_keyboard()
-                )
-            else:
-                await send_message_with_retry(
-                    update.message,
-                    "Ой, *неизвестная команда*! 😕 Пожалуйста, выбери действие из меню ниже! 👇",
-                    reply_markup=get_main_reply_keyboard()
-                )
-        elif text == "👥 Реферальная система":
-            if not context.user_data.get('subscription_confirmed', False):
-                logger.info(f"User {user_id} pressed Referral System without subscription.")
-                await prompt_subscribe(update, context)
-                return
-            user_data = get_user_data(user_id)
-            if not user_data:
-                logger.error(f"User {user_id} not found in Users sheet.")
-                await send_message_with_retry(update.message, "Упс, не удалось получить твои данные! 😢 Перезапусти бота.", reply_markup=get_main_reply_keyboard())
-                return
-            referral_link = f"https://t.me/{BOT_USERNAME}?start=invite_{user_id}"
-            logger.info(f"Generated referral link for user {user_id}: {referral_link}")
-            invited_users = user_data.get("invited_users", "0")
-            # Проверяем, есть ли пользователь в UNLIMITED_USERS
-            if user_id in UNLIMITED_USERS:
-                search_queries_text = "🔍 <b>Количество оставшихся запросов</b>: <b>∞ (безлимит)</b>"
-            else:
-                search_queries = user_data.get("search_queries", "0")
-                search_queries_text = f"🔍 <b>Количество оставшихся запросов</b>: <b>{search_queries}</b>"
-            referral_text = (
-                "<b>🔥 Реферальная система 🔥</b>\n\n"
-                "Приглашай друзей и получай <b>+2 поиска</b> за каждого, кто перейдёт по твоей ссылке и подпишется на наши каналы! 🚀\n\n"
-                f"Твоя реферальная ссылка:\n<a href='{referral_link}'>{referral_link}</a>\n"
-                "Копируй свою реферальную ссылку и зови друзей! 😎\n\n"
-                f"👥 <b>Количество добавленных пользователей</b>: <b>{invited_users}</b>\n"
-                f"{search_queries_text}"
-            )
-            await send_message_with_retry(update.message, referral_text, reply_markup=get_main_reply_keyboard(), parse_mode='HTML')
-        elif text == "❓ Как работает бот":
-            how_it_works_text = (
-                "🎬 *Как работает наш кино-бот?* 🎥\n\n"
-                "Я — твой личный помощник в мире кино! 🍿 Моя главная задача — помочь тебе найти фильмы по секретным числовым кодам. Вот как это работает:\n\n"
-                "🔍 *Поиск фильмов*:\n"
-                "1. Нажми на кнопку *🔍 Поиск фильма* в меню.\n"
-                "2. Подпишись на наши крутые спонсорские каналы или отправь заявку на вступление (это обязательно для поиска! 😎).\n"
-                "3. Введи *числовой код* фильма (только цифры!).\n"
-                "4. Я найду фильм в нашей базе и покажу его название! 🎉\n\n"
-                "👥 *Реферальная система*:\n"
-                "- Чтобы получить реферальную ссылку, подпишись на наши каналы! 🌟\n"
-                "- У тебя есть *5 бесплатных поисков* при старте! 🚀\n"
-                "- Приглашай друзей в бота, и за каждого, кто подпишется на каналы, ты получишь *+2 поиска*! 😍\n"
-                "- Если поиски закончились, приглашай друзей, чтобы продолжить! 🚀\n\n"
-                "❗ *Важно*:\n"
-                "- Подписка или заявка на вступление в каналы обязательна для поиска фильмов и использования реферальной системы.\n"
-                "- Вводи только числовые коды после нажатия *🔍 Поиск фильма*.\n"
-                "- Нажми *❌ Назад*, чтобы отменить поиск и вернуться в меню.\n"
-                "- Если что-то пошло не так, просто следуй подсказкам, и я помогу! 😊\n\n"
-                "Готов к кино-приключению? Выбери действие в меню! 👇"
-            )
-            await send_message_with_retry(update.message, how_it_works_text, reply_markup=get_main_reply_keyboard())
-        else:
-            logger.info(f"User {user_id} sent unknown command: {text}")
-            await send_message_with_retry(update.message, "Ой, *неизвестная команда*! 😕 Пожалуйста, выбери действие из меню ниже! 👇", reply_markup=get_main_reply_keyboard())
-    elif update.channel_post:
-        logger.warning("Ignoring channel post update")
+async def handle_back_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
+    if context.user_data.get('awaiting_code', False):
+        context.user_data['awaiting_code'] = False
+        logger.debug("User %s cancelled search mode.", user_id)
+        await send_message_with_retry(
+            update.message,
+            SEARCH_CANCELLED_TEXT,
+            reply_markup=MAIN_REPLY_KEYBOARD,
+            parse_mode=None
+        )
+    else:
+        await send_message_with_retry(
+            update.message,
+            UNKNOWN_COMMAND_TEXT,
+            reply_markup=MAIN_REPLY_KEYBOARD
+        )
+
+async def handle_referral_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.message.from_user.id
+    user_data = get_user_data(user_id)
+    if not user_data:
+        logger.error("User %s not found in Users sheet.", user_id)
+        await send_message_with_retry(update.message, USER_DATA_ERROR_TEXT, reply_markup=MAIN_REPLY_KEYBOARD, parse_mode=None)
+        return
+    referral_link = f"https://t.me/{BOT_USERNAME}?start=invite_{user_id}"
+    logger.debug("Generated referral link for user %s: %s", user_id, referral_link)
+    invited_users = user_data.get("invited_users", "0")
+    # Проверяем, есть ли пользователь в UNLIMITED_USERS
+    if user_id in UNLIMITED_USERS:
+        search_queries = "∞ (безлимит)"
+    else:
+        search_queries = user_data.get("search_queries", "0")
+    referral_text = REFERRAL_TEXT.format(
+        referral_link=referral_link,
+        invited_users=invited_users,
+        search_queries=search_queries
+    )
+    await send_message_with_retry(update.message, referral_text, reply_markup=MAIN_REPLY_KEYBOARD, parse_mode='HTML')
+
+async def handle_how_it_works_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await send_message_with_retry(update.message, HOW_IT_WORKS_TEXT, reply_markup=MAIN_REPLY_KEYBOARD)
+
+# Кнопка -> (обработчик, нужна ли подтверждённая подписка)
+BUTTON_HANDLERS = {
+    "🔍 Поиск фильма": (handle_search_button, True),
+    "❌ Назад": (handle_back_button, False),
+    "👥 Реферальная система": (handle_referral_button, True),
+    "❓ Как работает бот": (handle_how_it_works_button, False),
+}
+
+def allow_user_message(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    user_data = context.user_data
+    now = time.monotonic()
+    elapsed = now - user_data.get('rate_checked_at', now)
+    tokens = min(USER_MESSAGE_BURST, user_data.get('rate_tokens', USER_MESSAGE_BURST) + elapsed * USER_MESSAGE_RATE)
+    user_data['rate_checked_at'] = now
+    if tokens < 1:
+        user_data['rate_tokens'] = tokens
+        return False
+    user_data['rate_tokens'] = tokens - 1
+    user_data['rate_warned'] = False
+    return True
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not allow_user_message(context):
+        # Предупреждаем один раз за серию, остальные сообщения молча пропускаем
+        if not context.user_data.get('rate_warned', False):
+            context.user_data['rate_warned'] = True
+            await send_message_with_retry(update.message, THROTTLED_TEXT, parse_mode=None)
+        return
+    text = update.message.text
+    if DIGIT_RE.fullmatch(text):
+        await handle_movie_code(update, context)
+        return
+    entry = BUTTON_HANDLERS.get(text)
+    if not entry:
+        await handle_non_button_text(update, context)
         return
+    handler, requires_subscription = entry
+    if requires_subscription and not is_subscription_confirmed(update.message.from_user.id, context):
+        logger.debug("User %s pressed %s without subscription.", update.message.from_user.id, text)
+        await prompt_subscribe(update, context)
+        return
+    await handler(update, context)
 
 
 async def handle_non_button_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message.from_user.id == context.bot.id:
         return
-    logger.info(f"User {update.message.from_user.id} sent non-button text: {update.message.text}")
-    await send_message_with_retry(update.message, "Ой, *неизвестная команда*! 😕 Пожалуйста, выбери действие из меню! 👇", reply_markup=get_main_reply_keyboard())
+    logger.debug("User %s sent non-button text: %s", update.message.from_user.id, update.message.text)
+    await send_message_with_retry(update.message, UNKNOWN_COMMAND_TEXT, reply_markup=MAIN_REPLY_KEYBOARD)
 
 async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     join_request = update.chat_join_request
@@ -695,73 +1015,107 @@ async def handle_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE
     chat_id = join_request.chat.id
     if str(chat_id) in CHANNELS:
         await add_join_request(user_id, chat_id)
-        logger.info(f"User {user_id} sent join request to channel {chat_id}")
+        logger.info("User %s sent join request to channel %s", user_id, chat_id)
 
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    logger.error(f"Update {update} caused error: {context.error}")
-    if update.callback_query:
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Обновления обрабатываются в фоне после ответа вебхуку, поэтому все сбои логируются здесь
+    logger.error("Update %s caused error: %s", update, context.error, exc_info=context.error)
+    if isinstance(update, Update) and update.callback_query:
         await update.callback_query.answer()
         await edit_message_with_retry(
             context,
             update.callback_query.message.chat_id,
             update.callback_query.message.message_id,
-            "Упс, что-то пошло не так! 😢 Попробуй снова.",
+            ERROR_TEXT,
             reply_markup=None
         )
 
 async def webhook(request):
     """Handle incoming Telegram webhook updates."""
+    # Отсекаем чужие и слишком большие запросы до чтения и разбора тела
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    if request.content_type != "application/json" or not request.content_length:
+        return web.Response(status=400)
+    if request.content_length > MAX_WEBHOOK_BODY_SIZE:
+        return web.Response(status=413)
     try:
-        update = Update.de_json(await request.json(), application_tg.bot)
-        await application_tg.process_update(update)
+        data = orjson.loads(await request.read())
+        update_id = data.get("update_id")
+        # Telegram повторяет доставку, если не дождался ответа — дубликаты не обрабатываем
+        if update_id in PROCESSED_UPDATE_IDS:
+            logger.debug("Skipping duplicate update %s", update_id)
+            return web.Response(status=200)
+        # Ненужные боту обновления (в т.ч. сообщения без текста) отбрасываем до сборки объектов PTB
+        if not any(key in data for key in ALLOWED_UPDATES):
+            return web.Response(status=200)
+        if "message" in data and "text" not in data["message"]:
+            return web.Response(status=200)
+        update = Update.de_json(data, application_tg.bot)
+        # Обработка идёт в фоне через очередь приложения, Telegram сразу получает 200
+        await application_tg.update_queue.put(update)
+        # Отмечаем только поставленные в очередь: при ошибке выше Telegram повторит доставку
+        PROCESSED_UPDATE_IDS[update_id] = True
         return web.Response(status=200)
     except Exception as e:
-        logger.error(f"Error processing webhook update: {e}")
+        logger.error("Error processing webhook update: %s", e)
         return web.Response(status=500)
 
 async def reset_movie_cache():
-    global MOVIE_DICT
-    MOVIE_DICT.clear()
-    load_movie_cache.last_row = 0
-    logger.info("Movie cache cleared and last_row reset.")
+    logger.info("Forcing movie cache reload.")
     await load_movie_cache()
 
 async def reset_cache_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    # Замените YOUR_ADMIN_ID на ваш Telegram ID
-    if user_id == 6231911786:
+    if user_id in ADMIN_USERS:
         await reset_movie_cache()
         await send_message_with_retry(update.message, "Кэш фильмов сброшен и обновлён! 🎉")
     else:
         await send_message_with_retry(update.message, "У вас нет прав для этой команды! 😅")
 
+async def resolve_channel_ids():
+    global CHANNEL_PAIRS
+    for i, channel in enumerate(CHANNELS):
+        if isinstance(channel, str) and channel.startswith("@"):
+            try:
+                chat = await application_tg.bot.get_chat(channel)
+                CHANNELS[i] = str(chat.id)
+                logger.info("Resolved channel %s to chat ID %s", channel, chat.id)
+            except Exception as e:
+                logger.error("Failed to resolve channel %s: %s", channel, e)
+    CHANNEL_PAIRS = tuple(zip(CHANNELS, CHANNEL_BUTTON_ROWS))
+
 async def main():
     await init_google_sheets()
     application_tg.add_error_handler(error_handler)
     application_tg.add_handler(CommandHandler("start", start))
     application_tg.add_handler(CallbackQueryHandler(check_subscription, pattern="check_subscription"))
-    application_tg.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(r'^\d+$'), handle_movie_code))
-    application_tg.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
-    application_tg.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex(r'^\d+$'), handle_non_button_text))
+    # Только новые личные сообщения: правки и посты каналов сразу отсекаются фильтром
+    application_tg.add_handler(MessageHandler(filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, handle_text))
     application_tg.add_handler(ChatJoinRequestHandler(handle_join_request))
-    application_tg.add_handler(CommandHandler("resetcache", reset_cache_command))
-    await load_movie_cache()
+    application_tg.add_handler(CommandHandler(["resetcache", "reload"], reset_cache_command))
+    # Со снимком с диска первая загрузка из таблицы уходит в фоновое обновление
+    if not await load_movie_snapshot():
+        await load_movie_cache()
     await load_user_cache()
     await load_join_requests_cache()
     asyncio.create_task(refresh_movie_cache_periodically())
     asyncio.create_task(refresh_other_caches_periodically())
+    sheet_flusher = asyncio.create_task(flush_sheet_writes_periodically())
     asyncio.create_task(log_cache_size())
+    asyncio.create_task(log_lookup_stats())
     logger.info("Starting bot with webhook...")
 
     # Initialize the application
     await application_tg.initialize()
+    await resolve_channel_ids()
     await application_tg.start()
 
     # Set up the webhook
     port = int(os.environ.get("PORT", 8443))
     webhook_url = f"https://{os.environ.get('RENDER_EXTERNAL_HOSTNAME')}/webhook"
-    await application_tg.bot.set_webhook(url=webhook_url)
-    logger.info(f"Webhook set to {webhook_url}")
+    await application_tg.bot.set_webhook(url=webhook_url, secret_token=WEBHOOK_SECRET, allowed_updates=ALLOWED_UPDATES)
+    logger.info("Webhook set to %s", webhook_url)
 
     # Start the web server
     app = web.Application()
@@ -770,11 +1124,43 @@ async def main():
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', port)
     await site.start()
-    logger.info(f"Webhook server started on port {port}")
+    logger.info("Webhook server started on port %s", port)
+
+    # Платформа останавливает процесс через SIGTERM: отменяем main, чтобы выполнить завершение и выгрузку в таблицы
+    if sys.platform != "win32":
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
 
     # Keep the bot running
-    while True:
-        await asyncio.sleep(3600)
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    except asyncio.CancelledError:
+        logger.info("Shutdown requested.")
+    finally:
+        # Сначала перестаём принимать вебхуки, затем закрываем пул соединений PTB
+        await runner.cleanup()
+        await application_tg.stop()
+        await application_tg.shutdown()
+        # Фоновую выгрузку останавливаем до финальной, иначе её пачка может быть вне очереди и потеряться
+        sheet_flusher.cancel()
+        try:
+            await sheet_flusher
+        except asyncio.CancelledError:
+            pass
+        # Пачки ограничены SHEET_MAX_BATCH_ROWS — выгружаем очереди, пока они уменьшаются
+        pending = pending_sheet_rows()
+        while pending:
+            await flush_sheet_writes()
+            left = pending_sheet_rows()
+            if left >= pending:
+                logger.error("Abandoning %s unsaved rows on shutdown.", left)
+                break
+            pending = left
+        logger.info("Bot stopped.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if sys.platform != "win32":
+        import uvloop
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file